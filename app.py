@@ -1,9 +1,17 @@
+import io
+import os
+import tempfile
+from collections import OrderedDict
+
 import streamlit as st
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 import plotly.express as px
 import plotly.graph_objects as go
-from plotly.subplots import make_subplots
 
 # ---------------------------
 # CONFIG GLOBALE
@@ -38,34 +46,125 @@ st.markdown("**Analyse interactive du portefeuille de financements auto**")
 # ---------------------------
 # CHARGEMENT & NETTOYAGE
 # ---------------------------
-@st.cache_data
-def load_data(path: str) -> pd.DataFrame:
-    df = pd.read_excel(path)
-
-    # Nettoyage cohérent avec le rapport
-    df = df.copy()
-    # Taux d'endettement : valeurs présentes et entre 0 et 100
-    df = df[df["taux_endettement"].notna()]
-    df = df[(df["taux_endettement"] >= 0) & (df["taux_endettement"] <= 100)]
-    
-    # Suppression des emprunteurs mineurs (âge < 18 ans)
-    df["age"] = df["annee_demande"] - df["annee_naissance"]
-    df = df[df["age"] >= 18]
+DATA_PATH = "donnees_nettoyees.xlsx"
+
+# Colonnes à faible cardinalité stockées en `category` (codes entiers)
+CATEGORY_COLS = [
+    "type_pret",
+    "type_vehicule",
+    "classe_de_score",
+    "etat_demande",
+    "decision_client",
+    "objet_vehicule",
+    "departement",
+]
+
+# Colonnes filtrables, dans l'ordre des sélections de la signature
+FILTER_COLS = [
+    "objet_vehicule",
+    "type_pret",
+    "type_vehicule",
+    "classe_de_score",
+    "annee_demande",
+    "etat_demande",
+    "decision_client",
+]
+
+# Version du nettoyage : à incrémenter à chaque changement du pipeline ci-dessous,
+# elle fait partie du nom du cache Parquet (un ancien fichier n'est alors plus relu)
+SIDECAR_VERSION = 2
+
+def write_sidecar(df: pd.DataFrame, parquet_path: str) -> None:
+    # Écriture dans un fichier temporaire du même dossier puis renommage atomique :
+    # un crash ou un second worker ne laisse jamais de Parquet partiel à sa place.
+    # Le cache reste optionnel : un dossier en lecture seule n'empêche pas l'affichage.
+    dossier = os.path.dirname(os.path.abspath(parquet_path))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=dossier, prefix=os.path.basename(parquet_path) + ".", suffix=".tmp")
+    except OSError:
+        return
+    os.close(fd)
+    try:
+        df.to_parquet(tmp_path, engine="pyarrow", compression="zstd", index=False)
+        # mkstemp crée le fichier en 0600 : on rétablit les droits habituels (umask)
+        # pour qu'un worker sous un autre utilisateur puisse relire le cache
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, parquet_path)
+    except OSError:
+        pass
+    finally:
+        # Quelle que soit l'erreur, aucun fichier temporaire n'est laissé derrière
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def filter_options(df: pd.DataFrame) -> dict:
+    # Modalités proposées dans la sidebar ; les `category` sont déjà triées et uniques
+    return {
+        col: tuple(df[col].cat.categories)
+        if isinstance(df[col].dtype, pd.CategoricalDtype)
+        else tuple(sorted(df[col].dropna().unique()))
+        for col in FILTER_COLS
+    }
+
+# `mtime` ne sert qu'à la clé de cache : un fichier source modifié invalide l'entrée persistée
+@st.cache_data(persist="disk", show_spinner="Chargement des données…", max_entries=2)
+def load_data(path: str, mtime: float) -> tuple[pd.DataFrame, dict]:
+    # Cache Parquet à côté du fichier Excel : relu tant qu'il est plus récent que la source.
+    # Un fichier illisible (tronqué, vide, corrompu) ou sans aucune ligne est ignoré,
+    # les données sont alors reconstruites depuis l'Excel et le cache réécrit.
+    parquet_path = f"{path}.v{SIDECAR_VERSION}.parquet"
+    if os.path.exists(parquet_path) and os.path.getmtime(parquet_path) > mtime:
+        try:
+            # Lecture en memory-map (pages réutilisées depuis le cache de l'OS)
+            table = pq.read_table(parquet_path, memory_map=True)
+        except (pa.ArrowInvalid, OSError):
+            table = None
+        if table is not None and table.num_rows > 0:
+            # Parquet ne restitue pas les `category` non textuelles (classe_de_score)
+            df = table.to_pandas().astype({col: "category" for col in CATEGORY_COLS})
+            return df, filter_options(df)
+
+    # Lecteur XLSX natif (calamine, en Rust), bien plus rapide qu'openpyxl
+    df = pd.read_excel(path, engine="calamine")
+
+    # Nettoyage cohérent avec le rapport, en un seul masque :
+    # taux d'endettement présent et entre 0 et 100, suppression des emprunteurs mineurs (âge < 18 ans)
+    te = df["taux_endettement"].to_numpy(np.float64)
+    age = df["annee_demande"].to_numpy(np.int16) - df["annee_naissance"].to_numpy(np.int16)
+    keep = ~np.isnan(te) & (te >= 0) & (te <= 100) & (age >= 18)
+    df = df.loc[keep].copy()
+    # int16 : âges aberrants (> 127) conservés tels quels, sans débordement
+    df["age"] = age[keep]
 
     # Code postal en string, création d'un département (2 premiers chiffres)
-    df["code_postal"] = df["code_postal"].astype(str).str.zfill(5)
-    df["departement"] = df["code_postal"].str[:2]
+    # (noyaux pyarrow.compute sur buffers Arrow, sans passer par des objets Python)
+    code_postal = pc.utf8_lpad(pa.array(df["code_postal"].to_numpy()).cast(pa.string()), 5, "0")
+    df["code_postal"] = pd.array(code_postal, dtype="string[pyarrow]")
+    # (colonne passée en `category` plus bas : type des modalités identique au relu Parquet)
+    df["departement"] = pc.utf8_slice_codeunits(code_postal, 0, 2).to_numpy(zero_copy_only=False)
 
     # Construction d'une date "année-mois" pour les courbes temporelles
-    df["date_demande"] = pd.to_datetime({
-        "year": df["annee_demande"].astype(int),
-        "month": df["mois_demande"].astype(int),
-        "day": 1
-    }, errors="coerce")
+    years = df["annee_demande"].to_numpy(np.int64)
+    months = df["mois_demande"].to_numpy(np.int64)
+    date_demande = (years - 1970).astype("datetime64[Y]") + (months - 1).astype("timedelta64[M]")
+    # Mois hors 1-12 (la base contient des mois 13) : date invalide, comme errors="coerce"
+    date_demande[(months < 1) | (months > 12)] = np.datetime64("NaT")
+    df["date_demande"] = date_demande.astype("datetime64[ns]")
+
+    for col in CATEGORY_COLS:
+        df[col] = df[col].astype("category")
 
-    return df
+    # Une exception n'est pas mise en cache : un résultat vide n'est jamais persisté
+    if df.empty:
+        raise ValueError(f"Aucune donnée exploitable dans {path}")
 
-df = load_data("donnees_nettoyees.xlsx")
+    write_sidecar(df, parquet_path)
+    return df, filter_options(df)
+
+data_version = os.path.getmtime(DATA_PATH)
+df, options = load_data(DATA_PATH, data_version)
 
 # ---------------------------
 # SIDEBAR – FILTRES
@@ -73,13 +172,13 @@ df = load_data("donnees_nettoyees.xlsx")
 st.sidebar.header("🔧 Filtres interactifs")
 
 # Ajout des filtres manquants du rapport
-objets_veh = sorted(df["objet_vehicule"].dropna().unique())
-types_pret = sorted(df["type_pret"].dropna().unique())
-types_veh = sorted(df["type_vehicule"].dropna().unique())
-classes_score = sorted(df["classe_de_score"].dropna().unique())
-annees = sorted(df["annee_demande"].dropna().unique())
-etats = sorted(df["etat_demande"].dropna().unique())
-decisions_client = sorted(df["decision_client"].dropna().unique())
+objets_veh = options["objet_vehicule"]
+types_pret = options["type_pret"]
+types_veh = options["type_vehicule"]
+classes_score = options["classe_de_score"]
+annees = options["annee_demande"]
+etats = options["etat_demande"]
+decisions_client = options["decision_client"]
 
 # Nouveaux filtres
 objet_veh_sel = st.sidebar.multiselect(
@@ -124,317 +223,516 @@ decision_client_sel = st.sidebar.multiselect(
     default=decisions_client
 )
 
-# Filtrage avec tous les nouveaux critères
-df_filtre = df[
-    df["objet_vehicule"].isin(objet_veh_sel)
-    & df["type_pret"].isin(type_pret_sel)
-    & df["type_vehicule"].isin(type_veh_sel)
-    & df["classe_de_score"].isin(classe_sel)
-    & df["annee_demande"].isin(annee_sel)
-    & df["etat_demande"].isin(etat_sel)
-    & df["decision_client"].isin(decision_client_sel)
-]
-
-st.markdown(f"**📈 Nombre d'observations après filtrage :** {len(df_filtre):,}".replace(",", " "))
-
-# ---------------------------
-# KPI – INDICATEURS CLÉS AMÉLIORÉS
-# ---------------------------
-st.markdown("## 📊 Indicateurs clés de performance")
-
-col1, col2, col3, col4, col5, col6 = st.columns(6)
-
-with col1:
-    st.metric("Nombre de demandes", f"{len(df_filtre):,}".replace(",", " "))
-
-with col2:
-    montant_total = df_filtre["montant_pret"].sum()
-    st.metric("Montant total financé", f"{montant_total:,.0f} €".replace(",", " "))
-
-with col3:
-    montant_moyen = df_filtre["montant_pret"].mean()
-    st.metric("Montant moyen du prêt", f"{montant_moyen:,.0f} €".replace(",", " "))
-
-with col4:
-    if len(df_filtre) > 0:
-        taux_octroi = (df_filtre["etat_demande"].eq("Octroyé").mean()) * 100
-        st.metric("Taux d'octroi", f"{taux_octroi:.1f} %")
+def build_mask(df: pd.DataFrame, selections: dict) -> np.ndarray:
+    # Un seul masque booléen, combiné colonne par colonne sur les codes entiers
+    # des `category` ; on s'arrête dès qu'il ne reste plus aucune ligne
+    mask = np.ones(len(df), dtype=bool)
+    for col, sel in selections.items():
+        serie = df[col]
+        if isinstance(serie.dtype, pd.CategoricalDtype):
+            values = serie.cat.codes.to_numpy()
+            wanted = serie.cat.categories.get_indexer(list(sel))
+        else:
+            values = serie.to_numpy()
+            wanted = np.asarray(sel, dtype=values.dtype)
+        mask &= np.isin(values, wanted)
+        if not mask.any():
+            break
+    return mask
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def filter_mask(_df: pd.DataFrame, signature: tuple) -> np.ndarray:
+    return build_mask(_df, dict(zip(FILTER_COLS, signature[1])))
+
+def category_counts(df: pd.DataFrame, mask: np.ndarray, col: str) -> np.ndarray:
+    # Comptage en une passe sur les codes de la `category`, restreints au masque
+    serie = df[col]
+    codes = serie.cat.codes.to_numpy()[mask]
+    return np.bincount(codes[codes >= 0], minlength=len(serie.cat.categories))
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def count_by(_df: pd.DataFrame, _mask: np.ndarray, signature: tuple, col: str, sort_index: bool = False) -> pd.DataFrame:
+    nombre = category_counts(_df, _mask, col)
+    counts = pd.DataFrame({col: _df[col].cat.categories, "nombre": nombre})
+    # Modalités absentes du filtre retirées, comme avec value_counts
+    counts = counts[counts["nombre"] > 0]
+    if not sort_index:
+        counts = counts.sort_values("nombre", ascending=False, kind="stable")
+    return counts.reset_index(drop=True)
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def top_counts(_df: pd.DataFrame, _mask: np.ndarray, signature: tuple, col: str, n: int) -> pd.DataFrame:
+    # Seuil du n-ième effectif par sélection partielle (np.partition, O(k)) ; seules les
+    # modalités au-dessus du seuil sont triées, par effectif décroissant puis par code :
+    # à égalité au n-ième rang, la plus petite modalité l'emporte (résultat déterministe)
+    nombre = category_counts(_df, _mask, col)
+    n = min(n, np.count_nonzero(nombre))
+    if n == 0:
+        top = np.array([], dtype=np.intp)
     else:
-        st.metric("Taux d'octroi", "NA")
-
-with col5:
-    taux_end_moy = df_filtre["taux_endettement"].mean()
-    st.metric("Taux d'endettement moyen", f"{taux_end_moy:.1f} %")
-
-with col6:
-    age_moyen = df_filtre["age"].mean()
-    st.metric("Âge moyen", f"{age_moyen:.1f} ans")
+        seuil = np.partition(nombre, len(nombre) - n)[len(nombre) - n]
+        candidats = np.flatnonzero(nombre >= seuil)
+        top = candidats[np.lexsort((candidats, -nombre[candidats]))][:n]
+    return pd.DataFrame({col: _df[col].cat.categories[top], "nombre": nombre[top]})
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def monthly_counts(_df: pd.DataFrame, _mask: np.ndarray, signature: tuple) -> pd.DataFrame:
+    # Numéro de mois depuis 1970 ; les dates invalides (NaT) sont écartées
+    dates = _df["date_demande"].to_numpy()[_mask]
+    mois = dates[~np.isnat(dates)].astype("datetime64[M]").astype(np.int64)
+    if not len(mois):
+        return pd.DataFrame({
+            "date_demande": pd.Series(dtype="datetime64[ns]"),
+            "nombre": pd.Series(dtype=np.int64),
+        })
+    debut = mois.min()
+    nombre = np.bincount(mois - debut)
+    presents = np.flatnonzero(nombre)
+    return pd.DataFrame({
+        "date_demande": (presents + debut).astype("datetime64[M]").astype("datetime64[ns]"),
+        "nombre": nombre[presents],
+    })
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def histogram(_df: pd.DataFrame, _mask: np.ndarray, signature: tuple, col: str, bins: int) -> pd.DataFrame:
+    # Binning côté serveur : seules les classes et leurs effectifs partent au navigateur.
+    # Colonne `float` : classes repérées par leur centre. Colonne entière (durées en mois) :
+    # classes [début, fin] à bornes entières, repérées par leur début, avec `fin` incluse.
+    values = _df[col].to_numpy()[_mask]
+    entier = np.issubdtype(values.dtype, np.integer)
+    # Valeurs manquantes ignorées, comme px.histogram (np.histogram échoue sur NaN)
+    if not entier:
+        values = values[~np.isnan(values)]
+    if not len(values):
+        vide = {col: pd.Series(dtype=values.dtype), "nombre": pd.Series(dtype=np.int64)}
+        if entier:
+            vide["fin"] = pd.Series(dtype=values.dtype)
+        return pd.DataFrame(vide)
+    if entier:
+        debut, fin = int(values.min()), int(values.max())
+        pas = max(1, -(-(fin - debut + 1) // bins))
+        bords = np.arange(debut, fin + pas + 1, pas)
+        nombre, _ = np.histogram(values, bins=bords)
+        return pd.DataFrame({col: bords[:-1], "fin": bords[1:] - 1, "nombre": nombre})
+    nombre, bords = np.histogram(values, bins=bins)
+    return pd.DataFrame({col: (bords[:-1] + bords[1:]) / 2, "nombre": nombre})
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def box_stats(_df: pd.DataFrame, _mask: np.ndarray, signature: tuple, col: str, valeur: str) -> pd.DataFrame:
+    # Quartiles et moustaches (1,5 × IQR, bornées aux données) par modalité de `col`
+    serie = _df[col]
+    codes = serie.cat.codes.to_numpy()[_mask]
+    values = _df[valeur].to_numpy()[_mask]
+    rows = []
+    for code, modalite in enumerate(serie.cat.categories):
+        v = values[codes == code]
+        if not len(v):
+            continue
+        q1, median, q3 = np.percentile(v, [25, 50, 75])
+        iqr = q3 - q1
+        rows.append((
+            modalite,
+            v[v >= q1 - 1.5 * iqr].min(),
+            q1,
+            median,
+            q3,
+            v[v <= q3 + 1.5 * iqr].max(),
+        ))
+    return pd.DataFrame(rows, columns=[col, "lowerfence", "q1", "median", "q3", "upperfence"])
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def to_csv_bytes(_df: pd.DataFrame, _mask: np.ndarray, signature: tuple) -> bytes:
+    # Export CSV écrit par pyarrow (bien plus rapide que DataFrame.to_csv),
+    # recalculé uniquement quand les filtres changent
+    table = pa.Table.from_pandas(_df[_mask], preserve_index=False)
+    # Date seule ("2023-01-01"), comme l'export pandas d'origine, sans partie horaire
+    i = table.schema.get_field_index("date_demande")
+    table = table.set_column(i, "date_demande", table.column(i).cast(pa.date32()))
+    sink = io.BytesIO()
+    pa_csv.write_csv(table, sink)
+    return sink.getvalue()
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def preview_table(_df: pd.DataFrame, _mask: np.ndarray, signature: tuple, n: int = 500) -> pa.Table:
+    # Aperçu déjà converti en Arrow : st.dataframe l'affiche sans reconversion pandas
+    return pa.Table.from_pandas(_df.iloc[np.flatnonzero(_mask)[:n]], preserve_index=False)
+
+def view(df: pd.DataFrame, mask: np.ndarray, cols: list) -> pd.DataFrame:
+    # Lignes filtrées restreintes aux seules colonnes utilisées par un bloc
+    return df.loc[mask, cols]
+
+# Fragment : un clic sur le téléchargement ne relance que ce bloc, pas tout le
+# tableau de bord (les filtres de la sidebar, eux, ne peuvent pas vivre dans un fragment)
+@st.fragment
+def donnees_detaillees(df: pd.DataFrame, mask: np.ndarray, signature: tuple, n_filt: int) -> None:
+    st.dataframe(
+        preview_table(df, mask, signature),
+        use_container_width=True,
+        height=400
+    )
 
-st.markdown("---")
+    st.info(f"📊 Affichage de 500 lignes sur {n_filt:,} au total. Utilisez le bouton de téléchargement pour obtenir toutes les données.")
 
-# ---------------------------
-# NOUVELLE SECTION : ANALYSE DES DÉCISIONS
-# ---------------------------
-st.markdown('<div class="section-header">🎯 Analyse des décisions</div>', unsafe_allow_html=True)
-
-c1, c2 = st.columns(2)
-
-with c1:
-    st.subheader("Décision de la banque")
-    if not df_filtre.empty:
-        decision_banque = df_filtre["etat_demande"].value_counts()
-        fig_banque = px.pie(
-            values=decision_banque.values,
-            names=decision_banque.index,
-            color_discrete_sequence=px.colors.qualitative.Set2
-        )
-        fig_banque.update_traces(textposition='inside', textinfo='percent+label')
-        st.plotly_chart(fig_banque, use_container_width=True)
-
-with c2:
-    st.subheader("Décision du client")
-    if not df_filtre.empty:
-        decision_client = df_filtre["decision_client"].value_counts()
-        fig_client = px.pie(
-            values=decision_client.values,
-            names=decision_client.index,
-            color_discrete_sequence=px.colors.qualitative.Pastel
-        )
-        fig_client.update_traces(textposition='inside', textinfo='percent+label')
-        st.plotly_chart(fig_client, use_container_width=True)
+    # Statistiques résumées
+    with st.expander("📈 Statistiques descriptives des données filtrées"):
+        st.dataframe(view(df, mask, ['montant_pret', 'prix_achat', 'taux_endettement', 'taux_interet', 'duree_pret', 'age']).describe())
 
-# ---------------------------
-# LIGNE 1 – STRUCTURE DU PORTEFEUILLE AMÉLIORÉE
-# ---------------------------
-st.markdown('<div class="section-header">📈 Structure du portefeuille</div>', unsafe_allow_html=True)
-
-c3, c4, c5 = st.columns(3)
-
-with c3:
-    st.subheader("Répartition par type de prêt")
-    if not df_filtre.empty:
-        dist_pret = df_filtre["type_pret"].value_counts().reset_index()
-        dist_pret.columns = ["type_pret", "nombre"]
-        fig_pret = px.bar(
-            dist_pret,
-            x="type_pret",
-            y="nombre",
-            labels={"type_pret": "Type de prêt", "nombre": "Nombre de demandes"},
-            color="type_pret",
-            color_discrete_sequence=px.colors.qualitative.Bold
-        )
-        st.plotly_chart(fig_pret, use_container_width=True)
-
-with c4:
-    st.subheader("Objet du véhicule")
-    if not df_filtre.empty:
-        dist_objet = df_filtre["objet_vehicule"].value_counts().reset_index()
-        dist_objet.columns = ["objet_vehicule", "nombre"]
-        fig_objet = px.pie(
-            dist_objet,
-            values="nombre",
-            names="objet_vehicule",
-            color_discrete_sequence=px.colors.qualitative.Set3
-        )
-        fig_objet.update_traces(textposition='inside', textinfo='percent+label')
-        st.plotly_chart(fig_objet, use_container_width=True)
-
-with c5:
-    st.subheader("Type de véhicule")
-    if not df_filtre.empty:
-        dist_type_veh = df_filtre["type_vehicule"].value_counts().reset_index()
-        dist_type_veh.columns = ["type_vehicule", "nombre"]
-        fig_type_veh = px.bar(
-            dist_type_veh,
-            x="type_vehicule",
-            y="nombre",
-            labels={"type_vehicule": "Type de véhicule", "nombre": "Nombre de demandes"},
-            color="type_vehicule",
-            color_discrete_sequence=px.colors.qualitative.Vivid
-        )
-        st.plotly_chart(fig_type_veh, use_container_width=True)
+    csv = to_csv_bytes(df, mask, signature)
+    st.download_button(
+        label="📥 Télécharger les données filtrées (CSV)",
+        data=csv,
+        file_name="donnees_filtrees_credits_auto.csv",
+        mime="text/csv",
+        use_container_width=True
+    )
 
-# ---------------------------
-# LIGNE 2 – ANALYSE DES SCORES ET RISQUES
-# ---------------------------
-st.markdown('<div class="section-header">⚖️ Analyse des scores et risques</div>', unsafe_allow_html=True)
-
-c6, c7 = st.columns(2)
-
-with c6:
-    st.subheader("Répartition par classe de score")
-    if not df_filtre.empty:
-        dist_score = df_filtre["classe_de_score"].value_counts().sort_index().reset_index()
-        dist_score.columns = ["classe_de_score", "nombre"]
-        fig_score = px.bar(
-            dist_score,
-            x="classe_de_score",
-            y="nombre",
-            labels={"classe_de_score": "Classe de score", "nombre": "Nombre de demandes"},
-            color="nombre",
-            color_continuous_scale="Viridis"
+def category_bars(counts: pd.DataFrame, col: str, palette: list) -> go.Figure:
+    # Une barre (donc une entrée de légende) par modalité, comme px.bar(color=col)
+    fig = go.Figure([
+        go.Bar(
+            x=[modalite],
+            y=[nombre],
+            name=str(modalite),
+            marker_color=palette[i % len(palette)]
         )
-        st.plotly_chart(fig_score, use_container_width=True)
-
-with c7:
-    st.subheader("Taux d'endettement par classe de score")
-    if not df_filtre.empty:
-        fig_box = px.box(
-            df_filtre,
-            x="classe_de_score",
-            y="taux_endettement",
-            labels={
-                "classe_de_score": "Classe de score",
-                "taux_endettement": "Taux d'endettement (%)"
-            },
-            color="classe_de_score"
-        )
-        st.plotly_chart(fig_box, use_container_width=True)
+        for i, (modalite, nombre) in enumerate(zip(counts[col], counts["nombre"]))
+    ])
+    fig.update_layout(barmode="relative")
+    return fig
+
+# Toutes les figures du tableau de bord pour un état des filtres, indexées par graphique
+def build_figures(df: pd.DataFrame, mask: np.ndarray, signature: tuple) -> dict:
+    decision_banque = count_by(df, mask, signature, "etat_demande")
+    fig_banque = go.Figure(go.Pie(
+        labels=decision_banque["etat_demande"],
+        values=decision_banque["nombre"],
+        marker_colors=px.colors.qualitative.Set2
+    ))
+    fig_banque.update_traces(textposition='inside', textinfo='percent+label')
+
+    decision_client = count_by(df, mask, signature, "decision_client")
+    fig_client = go.Figure(go.Pie(
+        labels=decision_client["decision_client"],
+        values=decision_client["nombre"],
+        marker_colors=px.colors.qualitative.Pastel
+    ))
+    fig_client.update_traces(textposition='inside', textinfo='percent+label')
+
+    dist_pret = count_by(df, mask, signature, "type_pret")
+    fig_pret = category_bars(dist_pret, "type_pret", px.colors.qualitative.Bold)
+    fig_pret.update_layout(
+        xaxis_title="Type de prêt",
+        yaxis_title="Nombre de demandes",
+        legend_title_text="Type de prêt"
+    )
 
-# ---------------------------
-# NOUVELLE SECTION : ANALYSE FINANCIÈRE
-# ---------------------------
-st.markdown('<div class="section-header">💰 Analyse financière</div>', unsafe_allow_html=True)
-
-c8, c9 = st.columns(2)
-
-with c8:
-    st.subheader("Distribution du prix d'achat")
-    if not df_filtre.empty:
-        fig_prix = px.histogram(
-            df_filtre,
-            x="prix_achat",
-            nbins=50,
-            labels={"prix_achat": "Prix d'achat (€)", "count": "Nombre de demandes"},
-            color_discrete_sequence=['#2E86AB']
-        )
-        fig_prix.update_layout(bargap=0.1)
-        st.plotly_chart(fig_prix, use_container_width=True)
-
-with c9:
-    st.subheader("Distribution des taux d'intérêt")
-    if not df_filtre.empty:
-        fig_taux = px.histogram(
-            df_filtre,
-            x="taux_interet",
-            nbins=30,
-            labels={"taux_interet": "Taux d'intérêt (%)", "count": "Nombre de demandes"},
-            color_discrete_sequence=['#A23B72']
-        )
-        st.plotly_chart(fig_taux, use_container_width=True)
+    dist_objet = count_by(df, mask, signature, "objet_vehicule")
+    fig_objet = go.Figure(go.Pie(
+        labels=dist_objet["objet_vehicule"],
+        values=dist_objet["nombre"],
+        marker_colors=px.colors.qualitative.Set3
+    ))
+    fig_objet.update_traces(textposition='inside', textinfo='percent+label')
+
+    dist_type_veh = count_by(df, mask, signature, "type_vehicule")
+    fig_type_veh = category_bars(dist_type_veh, "type_vehicule", px.colors.qualitative.Vivid)
+    fig_type_veh.update_layout(
+        xaxis_title="Type de véhicule",
+        yaxis_title="Nombre de demandes",
+        legend_title_text="Type de véhicule"
+    )
 
-# ---------------------------
-# LIGNE 3 – ANALYSE TEMPORELLE
-# ---------------------------
-st.markdown('<div class="section-header">📅 Analyse temporelle</div>', unsafe_allow_html=True)
-
-c10, c11 = st.columns(2)
-
-with c10:
-    st.subheader("Évolution mensuelle des demandes")
-    if not df_filtre["date_demande"].isna().all():
-        ts = (
-            df_filtre
-            .dropna(subset=["date_demande"])
-            .groupby("date_demande")
-            .size()
-            .reset_index(name="nombre")
-        )
-        fig_ts = px.area(
-            ts,
-            x="date_demande",
-            y="nombre",
-            labels={"date_demande": "Date de demande", "nombre": "Nombre de demandes"},
-            color_discrete_sequence=['#3498db']
+    dist_score = count_by(df, mask, signature, "classe_de_score", sort_index=True)
+    fig_score = go.Figure(go.Bar(
+        x=dist_score["classe_de_score"],
+        y=dist_score["nombre"],
+        marker={
+            "color": dist_score["nombre"],
+            "colorscale": "Viridis",
+            "showscale": True,
+            "colorbar": {"title": {"text": "Nombre de demandes"}}
+        }
+    ))
+    fig_score.update_layout(xaxis_title="Classe de score", yaxis_title="Nombre de demandes")
+
+    stats_box = box_stats(df, mask, signature, "classe_de_score", "taux_endettement")
+    fig_box = go.Figure([
+        go.Box(
+            x=[row.classe_de_score],
+            name=str(row.classe_de_score),
+            lowerfence=[row.lowerfence],
+            q1=[row.q1],
+            median=[row.median],
+            q3=[row.q3],
+            upperfence=[row.upperfence],
         )
-        st.plotly_chart(fig_ts, use_container_width=True)
-
-with c11:
-    st.subheader("Distribution des durées de prêt")
-    if not df_filtre.empty:
-        fig_duree = px.histogram(
-            df_filtre,
-            x="duree_pret",
-            nbins=20,
-            labels={"duree_pret": "Durée du prêt (mois)", "count": "Nombre de demandes"},
-            color_discrete_sequence=['#F18F01']
-        )
-        st.plotly_chart(fig_duree, use_container_width=True)
-
-# ---------------------------
-# LIGNE 4 – DIMENSION GÉOGRAPHIQUE
-# ---------------------------
-st.markdown('<div class="section-header">🗺️ Analyse géographique</div>', unsafe_allow_html=True)
-
-st.subheader("Top 15 des départements par nombre de demandes")
-
-if not df_filtre.empty:
-    top_dep = (
-        df_filtre
-        .groupby("departement")
-        .size()
-        .reset_index(name="nombre")
-        .sort_values("nombre", ascending=False)
-        .head(15)
+        for row in stats_box.itertuples()
+    ])
+    fig_box.update_layout(
+        xaxis_title="Classe de score",
+        yaxis_title="Taux d'endettement (%)",
+        legend_title_text="Classe de score"
     )
-    
-    fig_dep = px.bar(
-        top_dep,
-        x="nombre",
-        y="departement",
+
+    hist_prix = histogram(df, mask, signature, "prix_achat", 50)
+    fig_prix = go.Figure(go.Bar(
+        x=hist_prix["prix_achat"],
+        y=hist_prix["nombre"],
+        marker_color='#2E86AB'
+    ))
+    fig_prix.update_layout(xaxis_title="Prix d'achat (€)", yaxis_title="Nombre de demandes", bargap=0.1)
+
+    hist_taux = histogram(df, mask, signature, "taux_interet", 30)
+    fig_taux = go.Figure(go.Bar(
+        x=hist_taux["taux_interet"],
+        y=hist_taux["nombre"],
+        marker_color='#A23B72'
+    ))
+    fig_taux.update_layout(xaxis_title="Taux d'intérêt (%)", yaxis_title="Nombre de demandes", bargap=0)
+
+    ts = monthly_counts(df, mask, signature)
+    fig_ts = None
+    if not ts.empty:
+        fig_ts = go.Figure(go.Scatter(
+            x=ts["date_demande"],
+            y=ts["nombre"],
+            mode="lines",
+            fill="tozeroy",
+            line_color='#3498db'
+        ))
+        fig_ts.update_layout(xaxis_title="Date de demande", yaxis_title="Nombre de demandes")
+
+    hist_duree = histogram(df, mask, signature, "duree_pret", 20)
+    # Barres calées sur les bornes entières des classes, de `début` à `fin` incluse
+    fig_duree = go.Figure(go.Bar(
+        x=hist_duree["duree_pret"],
+        y=hist_duree["nombre"],
+        width=hist_duree["fin"] - hist_duree["duree_pret"] + 1,
+        offset=0,
+        customdata=hist_duree["fin"],
+        hovertemplate="%{x}–%{customdata} mois<br>%{y} demandes<extra></extra>",
+        marker_color='#F18F01'
+    ))
+    fig_duree.update_layout(xaxis_title="Durée du prêt (mois)", yaxis_title="Nombre de demandes", bargap=0)
+
+    top_dep = top_counts(df, mask, signature, "departement", 15)
+
+    fig_dep = go.Figure(go.Bar(
+        x=top_dep["nombre"],
+        y=top_dep["departement"],
         orientation="h",
-        labels={"departement": "Département", "nombre": "Nombre de demandes"},
-        color="nombre",
-        color_continuous_scale="blues",
-        text="nombre"
-    )
-    
+        marker={
+            "color": top_dep["nombre"],
+            "colorscale": "blues",
+            "showscale": True,
+            "colorbar": {"title": {"text": "Nombre de demandes"}}
+        },
+        text=top_dep["nombre"]
+    ))
+
     fig_dep.update_layout(
-        yaxis={"categoryorder": "total ascending"},
+        # Codes département ("01", "75"…) lus comme catégories, pas comme nombres
+        yaxis={"type": "category", "categoryorder": "total ascending"},
         height=500,
         showlegend=False,
         xaxis_title="Nombre de demandes",
         yaxis_title="Département",
         plot_bgcolor='white'
     )
-    
+
     fig_dep.update_traces(
         texttemplate='%{text:,}',
         textposition='outside',
         marker_line_color='darkblue',
         marker_line_width=1
     )
-    
-    st.plotly_chart(fig_dep, use_container_width=True)
 
-# ---------------------------
-# TABLE + TÉLÉCHARGEMENT
-# ---------------------------
-st.markdown('<div class="section-header">📋 Données détaillées</div>', unsafe_allow_html=True)
+    return {
+        "banque": fig_banque,
+        "client": fig_client,
+        "pret": fig_pret,
+        "objet": fig_objet,
+        "type_veh": fig_type_veh,
+        "score": fig_score,
+        "box": fig_box,
+        "prix": fig_prix,
+        "taux": fig_taux,
+        "ts": fig_ts,
+        "duree": fig_duree,
+        "dep": fig_dep,
+    }
 
-st.subheader("Échantillon des données filtrées")
+# Figures déjà construites, par signature de filtres, dans la session de l'utilisateur :
+# revenir sur un état déjà vu évite agrégations et construction. LRU borné à FIGURES_MAX.
+FIGURES_MAX = 16
 
-if not df_filtre.empty:
-    st.dataframe(
-        df_filtre.head(500),
-        use_container_width=True,
-        height=400
-    )
-    
-    st.info(f"📊 Affichage de 500 lignes sur {len(df_filtre):,} au total. Utilisez le bouton de téléchargement pour obtenir toutes les données.")
-    
-    # Statistiques résumées
-    with st.expander("📈 Statistiques descriptives des données filtrées"):
-        st.dataframe(df_filtre[['montant_pret', 'prix_achat', 'taux_endettement', 'taux_interet', 'duree_pret', 'age']].describe())
-    
-    csv = df_filtre.to_csv(index=False).encode("utf-8")
-    st.download_button(
-        label="📥 Télécharger les données filtrées (CSV)",
-        data=csv,
-        file_name="donnees_filtrees_credits_auto.csv",
-        mime="text/csv",
-        use_container_width=True
-    )
+def session_figures(df: pd.DataFrame, mask: np.ndarray, signature: tuple) -> dict:
+    cache = st.session_state.setdefault("figures", OrderedDict())
+    if signature in cache:
+        cache.move_to_end(signature)
+    else:
+        cache[signature] = build_figures(df, mask, signature)
+        if len(cache) > FIGURES_MAX:
+            cache.popitem(last=False)
+    return cache[signature]
+
+# Signature des filtres (hashable) : version des données + sélections en tuples.
+# Les DataFrames sont passés en paramètre `_`-préfixé (non hashé), seule la
+# signature sert de clé de cache.
+filtres = (
+    tuple(objet_veh_sel),
+    tuple(type_pret_sel),
+    tuple(type_veh_sel),
+    tuple(classe_sel),
+    tuple(annee_sel),
+    tuple(etat_sel),
+    tuple(decision_client_sel),
+)
+signature = (data_version, filtres)
+
+# Filtrage avec tous les nouveaux critères
+mask = filter_mask(df, signature)
+n_filt = int(mask.sum())
+
+st.markdown(f"**📈 Nombre d'observations après filtrage :** {n_filt:,}".replace(",", " "))
+
+# Un seul test sur le nombre de lignes filtrées : sans résultat, aucun calcul ni graphique
+if n_filt == 0:
+    st.info("Aucune demande ne correspond aux filtres sélectionnés.")
+else:
+    # ---------------------------
+    # KPI – INDICATEURS CLÉS AMÉLIORÉS
+    # ---------------------------
+    st.markdown("## 📊 Indicateurs clés de performance")
+
+    kpi = view(df, mask, ["montant_pret", "etat_demande", "taux_endettement", "age"])
+
+    col1, col2, col3, col4, col5, col6 = st.columns(6)
+
+    with col1:
+        st.metric("Nombre de demandes", f"{n_filt:,}".replace(",", " "))
+
+    with col2:
+        montant_total = kpi["montant_pret"].sum()
+        st.metric("Montant total financé", f"{montant_total:,.0f} €".replace(",", " "))
+
+    with col3:
+        montant_moyen = kpi["montant_pret"].mean()
+        st.metric("Montant moyen du prêt", f"{montant_moyen:,.0f} €".replace(",", " "))
+
+    with col4:
+        taux_octroi = (kpi["etat_demande"].eq("Octroyé").mean()) * 100
+        st.metric("Taux d'octroi", f"{taux_octroi:.1f} %")
+
+    with col5:
+        taux_end_moy = kpi["taux_endettement"].mean()
+        st.metric("Taux d'endettement moyen", f"{taux_end_moy:.1f} %")
+
+    with col6:
+        age_moyen = kpi["age"].mean()
+        st.metric("Âge moyen", f"{age_moyen:.1f} ans")
+
+    st.markdown("---")
+
+    figures = session_figures(df, mask, signature)
+
+    # ---------------------------
+    # NOUVELLE SECTION : ANALYSE DES DÉCISIONS
+    # ---------------------------
+    st.markdown('<div class="section-header">🎯 Analyse des décisions</div>', unsafe_allow_html=True)
+
+    c1, c2 = st.columns(2)
+
+    with c1:
+        st.subheader("Décision de la banque")
+        st.plotly_chart(figures["banque"], use_container_width=True)
+
+    with c2:
+        st.subheader("Décision du client")
+        st.plotly_chart(figures["client"], use_container_width=True)
+
+    # ---------------------------
+    # LIGNE 1 – STRUCTURE DU PORTEFEUILLE AMÉLIORÉE
+    # ---------------------------
+    st.markdown('<div class="section-header">📈 Structure du portefeuille</div>', unsafe_allow_html=True)
+
+    c3, c4, c5 = st.columns(3)
+
+    with c3:
+        st.subheader("Répartition par type de prêt")
+        st.plotly_chart(figures["pret"], use_container_width=True)
+
+    with c4:
+        st.subheader("Objet du véhicule")
+        st.plotly_chart(figures["objet"], use_container_width=True)
+
+    with c5:
+        st.subheader("Type de véhicule")
+        st.plotly_chart(figures["type_veh"], use_container_width=True)
+
+    # ---------------------------
+    # LIGNE 2 – ANALYSE DES SCORES ET RISQUES
+    # ---------------------------
+    st.markdown('<div class="section-header">⚖️ Analyse des scores et risques</div>', unsafe_allow_html=True)
+
+    c6, c7 = st.columns(2)
+
+    with c6:
+        st.subheader("Répartition par classe de score")
+        st.plotly_chart(figures["score"], use_container_width=True)
+
+    with c7:
+        st.subheader("Taux d'endettement par classe de score")
+        st.plotly_chart(figures["box"], use_container_width=True)
+
+    # ---------------------------
+    # NOUVELLE SECTION : ANALYSE FINANCIÈRE
+    # ---------------------------
+    st.markdown('<div class="section-header">💰 Analyse financière</div>', unsafe_allow_html=True)
+
+    c8, c9 = st.columns(2)
+
+    with c8:
+        st.subheader("Distribution du prix d'achat")
+        st.plotly_chart(figures["prix"], use_container_width=True)
+
+    with c9:
+        st.subheader("Distribution des taux d'intérêt")
+        st.plotly_chart(figures["taux"], use_container_width=True)
+
+    # ---------------------------
+    # LIGNE 3 – ANALYSE TEMPORELLE
+    # ---------------------------
+    st.markdown('<div class="section-header">📅 Analyse temporelle</div>', unsafe_allow_html=True)
+
+    c10, c11 = st.columns(2)
+
+    with c10:
+        st.subheader("Évolution mensuelle des demandes")
+        if figures["ts"] is not None:
+            st.plotly_chart(figures["ts"], use_container_width=True)
+
+    with c11:
+        st.subheader("Distribution des durées de prêt")
+        st.plotly_chart(figures["duree"], use_container_width=True)
+
+    # ---------------------------
+    # LIGNE 4 – DIMENSION GÉOGRAPHIQUE
+    # ---------------------------
+    st.markdown('<div class="section-header">🗺️ Analyse géographique</div>', unsafe_allow_html=True)
+
+    st.subheader("Top 15 des départements par nombre de demandes")
+
+    st.plotly_chart(figures["dep"], use_container_width=True)
+
+    # ---------------------------
+    # TABLE + TÉLÉCHARGEMENT
+    # ---------------------------
+    st.markdown('<div class="section-header">📋 Données détaillées</div>', unsafe_allow_html=True)
+
+    st.subheader("Échantillon des données filtrées")
+
+    donnees_detaillees(df, mask, signature, n_filt)
 
 # ---------------------------
 # FOOTER INFORMATIF